@@ -4,15 +4,84 @@ Rare Bird Sighting Alerts
 Monitors eBird for rare/notable bird sightings near your location
 """
 
-import requests
-import json
+import hashlib
 import os
-from datetime import datetime
+import sqlite3
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+import jinja2
+import orjson
+from requests.adapters import HTTPAdapter
+from requests_cache import DEFAULT_IGNORED_PARAMS, CachedSession
+from urllib3.util.retry import Retry
+
+
+# Most sightings listed in a single email
+MAX_EMAIL_SIGHTINGS = 10
+
+
+def _format_obs_date(obs_date: Optional[str]) -> str:
+    """Format an eBird observation date for display"""
+    # eBird already sends 'YYYY-MM-DD HH:MM' (or just 'YYYY-MM-DD'), no parsing needed
+    return obs_date[:16] if obs_date else ''
+
+
+_HTML_SRC = """
+        <html>
+        <body style="font-family: Arial, sans-serif;">
+            <h2 style="color: #4CAF50;">🐦 Rare Bird Sightings Alert!</h2>
+            <p><strong>{{ sightings|length }} notable bird{{ 's' if sightings|length > 1 }} spotted within {{ radius_km }}km of your location!</strong></p>
+            <p style="color: #666;"><em>Märsta, Stockholm area</em></p>
+            
+            <div style="margin: 20px 0;">
+        {% for s in sightings[:max_shown] %}{# Limit to the most recent #}
+        {%- set how_many = s.howMany|default(1) %}
+                <div style="background: #f9f9f9; border-left: 4px solid #4CAF50; padding: 15px; margin: 15px 0; border-radius: 5px;">
+                    <h3 style="color: #333; margin: 0 0 10px 0;">{{ s.comName|default('Unknown species') }}</h3>
+                    <p style="color: #666; font-style: italic; margin: 5px 0;">{{ s.sciName|default('') }}</p>
+                    <p style="margin: 5px 0;"><strong>📍 Location:</strong> {{ s.locName|default('Unknown location') }}</p>
+                    <p style="margin: 5px 0;"><strong>🕐 When:</strong> {{ s.obsDt|obs_date }}</p>
+                    <p style="margin: 5px 0;"><strong>🔢 Count:</strong> {{ how_many }} individual{{ 's' if how_many != 1 }}</p>
+                    <p style="margin: 10px 0;">
+                        <a href="https://www.google.com/maps?q={{ s.lat|default(0) }},{{ s.lng|default(0) }}" style="background: #4CAF50; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; display: inline-block;">
+                            📍 View on Map
+                        </a>
+                        <a href="https://ebird.org/map" style="background: #2196F3; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; display: inline-block; margin-left: 10px;">
+                            🐦 View on eBird
+                        </a>
+                    </p>
+                </div>
+        {% endfor %}
+            </div>
+            
+            <div style="background: #e8f5e9; padding: 15px; border-radius: 5px; margin-top: 20px;">
+                <h3 style="color: #2e7d32;">🔍 Birding Tips:</h3>
+                <ul style="color: #333;">
+                    <li>Bring binoculars and a field guide</li>
+                    <li>Visit early morning (5-9 AM) or late afternoon (4-7 PM)</li>
+                    <li>Be quiet and patient</li>
+                    <li>Check weather conditions before going</li>
+                    <li>Respect private property and wildlife</li>
+                </ul>
+            </div>
+            
+            <p style="margin-top: 20px; color: #666; font-size: 0.9em;">
+                <em>Happy birding! 🐦 Data from eBird</em>
+            </p>
+        </body>
+        </html>
+"""
+
+# Compiled once at import; autoescape keeps API-supplied names from injecting HTML
+_env = jinja2.Environment(autoescape=True)
+_env.filters['obs_date'] = _format_obs_date
+_TEMPLATE = _env.from_string(_HTML_SRC)
+
+
 class BirdNotifier:
     def __init__(self):
         # eBird API configuration
@@ -27,28 +96,65 @@ class BirdNotifier:
         # How many days back to check
         self.days_back = int(os.getenv('DAYS_BACK', '3'))
         
+        # Shared HTTP session so eBird calls reuse pooled keep-alive connections.
+        # Responses are cached on disk; taxonomy data rarely changes between runs.
+        self._session = CachedSession(
+            os.getenv('EBIRD_CACHE', 'ebird_cache.sqlite'),
+            backend='sqlite',
+            expire_after=timedelta(days=30),
+            allowable_methods=('GET',),
+            cache_control=True,
+            # Keep the API token out of cache keys and the stored requests
+            ignored_parameters=[*DEFAULT_IGNORED_PARAMS, 'x-ebirdapitoken']
+        )
+        self._session.headers.update({
+            'x-ebirdapitoken': self.ebird_api_key,
+            'Accept-Encoding': 'gzip, deflate'
+        })
+        self._session.mount('https://', HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=50,
+            max_retries=Retry(total=3, backoff_factor=0.3,
+                              status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        
+        # Sightings we've already emailed about, kept between runs
+        self._db = sqlite3.connect(os.getenv('NOTIFIED_DB', 'notified.sqlite'))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS notified('
+            'sub_id TEXT, species TEXT, obs_dt TEXT, loc_id TEXT, how_many INTEGER, '
+            'PRIMARY KEY(sub_id, species, obs_dt))'
+        )
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(notified)')}
+        for column in ('loc_id TEXT', 'how_many INTEGER'):
+            if column.split()[0] not in columns:
+                self._db.execute(f'ALTER TABLE notified ADD COLUMN {column}')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS notified_repost ON notified(species, loc_id, obs_dt)'
+        )
+        self._db.execute('CREATE TABLE IF NOT EXISTS state(key TEXT PRIMARY KEY, value TEXT)')
+        
     def get_notable_sightings(self) -> List[Dict]:
         """Fetch notable/rare bird sightings from eBird"""
         try:
             # Notable observations endpoint
             url = f"{self.base_url}/data/obs/geo/recent/notable"
             
-            headers = {
-                'x-ebirdapitoken': self.ebird_api_key
-            }
-            
             params = {
                 'lat': self.latitude,
                 'lng': self.longitude,
                 'dist': self.radius_km,
                 'back': self.days_back,
-                'detail': 'full'
+                # 'simple' has every field the email uses
+                'detail': 'simple'
             }
             
-            response = requests.get(url, headers=headers, params=params, timeout=10)
+            # Sightings change often; only dedupe rapid re-runs
+            response = self._session.get(url, params=params, timeout=10,
+                                         expire_after=timedelta(minutes=5))
             response.raise_for_status()
             
-            sightings = response.json()
+            sightings = orjson.loads(response.content)
             print(f"Found {len(sightings)} notable bird sightings")
             
             return sightings
@@ -59,30 +165,84 @@ class BirdNotifier:
     
     def get_species_info(self, species_code: str) -> Optional[Dict]:
         """Get additional info about a species"""
+        return self.get_species_info_bulk([species_code]).get(species_code)
+    
+    def get_species_info_bulk(self, species_codes: List[str]) -> Dict[str, Dict]:
+        """Get taxonomy info for several species in a single request"""
+        codes = sorted(set(species_codes))
+        if not codes:
+            return {}
+        
         try:
-            # Get taxonomy info
+            # The taxonomy endpoint accepts a comma-separated species list
             url = f"{self.base_url}/ref/taxonomy/ebird"
-            headers = {'x-ebirdapitoken': self.ebird_api_key}
-            params = {'species': species_code, 'fmt': 'json'}
+            params = {'species': ','.join(codes), 'fmt': 'json'}
             
-            response = requests.get(url, headers=headers, params=params, timeout=10)
+            response = self._session.get(url, params=params, timeout=15)
             if response.ok:
-                data = response.json()
-                return data[0] if data else None
-            return None
-        except:
-            return None
+                return {row['speciesCode']: row for row in orjson.loads(response.content)}
+            return {}
+        except Exception:
+            return {}
     
     def filter_new_sightings(self, sightings: List[Dict]) -> List[Dict]:
         """Filter out sightings we've already notified about"""
-        # In production, you'd store notified sightings in a file/database
-        # For now, we'll just return all sightings
-        # You can add a simple JSON file to track what's been sent
+        # The same bird is often reported by several observers; drop the
+        # reposts first so nothing downstream processes them twice
+        seen = set()
+        unique_sightings = []
+        for sighting in sightings:
+            key = self._repost_key(sighting)
+            if key in seen:
+                continue
+            seen.add(key)
+            unique_sightings.append(sighting)
         
-        return sightings
+        return [s for s in unique_sightings if not self._was_notified(s)]
+    
+    def _notified_key(self, sighting: Dict) -> tuple:
+        return (sighting.get('subId'), sighting.get('speciesCode'), sighting.get('obsDt'))
+    
+    def _repost_key(self, sighting: Dict) -> tuple:
+        return (sighting.get('speciesCode'), sighting.get('locId'),
+                sighting.get('obsDt'), sighting.get('howMany'))
     
-    def send_email_notification(self, sightings: List[Dict]):
-        """Send email notification about rare bird sightings"""
+    def _was_notified(self, sighting: Dict) -> bool:
+        # Match the sighting itself, or a repost of the same bird by another observer
+        row = self._db.execute(
+            'SELECT 1 FROM notified WHERE (sub_id IS ? AND species IS ? AND obs_dt IS ?) '
+            'OR (species IS ? AND loc_id IS ? AND obs_dt IS ? AND how_many IS ?)',
+            self._notified_key(sighting) + self._repost_key(sighting)
+        ).fetchone()
+        return row is not None
+    
+    def mark_notified(self, sightings: List[Dict]):
+        """Remember sightings so later runs don't email them again"""
+        self._db.executemany(
+            'INSERT OR IGNORE INTO notified(sub_id, species, obs_dt, loc_id, how_many) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [self._notified_key(s) + (s.get('locId'), s.get('howMany')) for s in sightings]
+        )
+        # Sightings older than the search window can't come back, forget them
+        cutoff = (datetime.now() - timedelta(days=self.days_back + 1)).strftime('%Y-%m-%d')
+        self._db.execute('DELETE FROM notified WHERE obs_dt < ?', (cutoff,))
+        self._db.commit()
+    
+    def _sightings_signature(self, sightings: List[Dict]) -> str:
+        # Hash of every sighting's notified key, so any added sighting changes it
+        keys = sorted('|'.join(str(v) for v in self._notified_key(s)) for s in sightings)
+        return hashlib.sha256('\n'.join(keys).encode()).hexdigest()
+    
+    def _get_state(self, key: str) -> Optional[str]:
+        row = self._db.execute('SELECT value FROM state WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_state(self, key: str, value: str):
+        self._db.execute('INSERT OR REPLACE INTO state(key, value) VALUES (?, ?)', (key, value))
+        self._db.commit()
+    
+    def send_email_notification(self, sightings: List[Dict]) -> bool:
+        """Send email notification about rare bird sightings, returns True if sent"""
         smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
         smtp_port = int(os.getenv('SMTP_PORT', '587'))
         sender_email = os.getenv('SENDER_EMAIL')
@@ -91,11 +251,11 @@ class BirdNotifier:
         
         if not all([sender_email, sender_password, receiver_emails]):
             print("Email credentials not configured")
-            return
+            return False
         
         if not sightings:
             print("No sightings to notify about")
-            return
+            return False
         
         receiver_list = [email.strip() for email in receiver_emails.split(',')]
         
@@ -109,86 +269,47 @@ class BirdNotifier:
         msg.attach(MIMEText(body, 'html'))
         
         try:
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            server.starttls()
-            server.login(sender_email, sender_password)
+            server = self._smtp_connect(smtp_server, smtp_port, sender_email, sender_password)
+        except Exception as e:
+            print(f"Error sending email: {e}")
+            return False
+        
+        try:
             server.send_message(msg)
-            server.quit()
             print(f"Email notification sent to {len(receiver_list)} recipient(s)!")
+            return True
         except Exception as e:
             print(f"Error sending email: {e}")
+            return False
+        finally:
+            self._close_smtp(server)
+    
+    def _smtp_connect(self, smtp_server: str, smtp_port: int,
+                      sender_email: str, sender_password: str) -> smtplib.SMTP:
+        """Open an authenticated SMTP connection"""
+        server = smtplib.SMTP(smtp_server, smtp_port)
+        try:
+            server.starttls()
+            server.login(sender_email, sender_password)
+        except Exception:
+            server.close()
+            raise
+        return server
+    
+    def _close_smtp(self, server: smtplib.SMTP):
+        # A failed goodbye mustn't turn a delivered email into an error
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                server.close()
+            except OSError:
+                pass
     
     def _format_email_body(self, sightings: List[Dict]) -> str:
         """Format HTML email body"""
-        
-        html = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif;">
-            <h2 style="color: #4CAF50;">🐦 Rare Bird Sightings Alert!</h2>
-            <p><strong>{len(sightings)} notable bird{'s' if len(sightings) > 1 else ''} spotted within {self.radius_km}km of your location!</strong></p>
-            <p style="color: #666;"><em>Märsta, Stockholm area</em></p>
-            
-            <div style="margin: 20px 0;">
-        """
-        
-        for sighting in sightings[:10]:  # Limit to 10 most recent
-            species_name = sighting.get('comName', 'Unknown species')
-            scientific_name = sighting.get('sciName', '')
-            location = sighting.get('locName', 'Unknown location')
-            obs_date = sighting.get('obsDt', '')
-            how_many = sighting.get('howMany', 1)
-            lat = sighting.get('lat', 0)
-            lng = sighting.get('lng', 0)
-            
-            # Format date
-            try:
-                dt = datetime.fromisoformat(obs_date.replace('Z', '+00:00'))
-                formatted_date = dt.strftime('%Y-%m-%d %H:%M')
-            except:
-                formatted_date = obs_date
-            
-            # Google Maps link
-            maps_url = f"https://www.google.com/maps?q={lat},{lng}"
-            
-            html += f"""
-                <div style="background: #f9f9f9; border-left: 4px solid #4CAF50; padding: 15px; margin: 15px 0; border-radius: 5px;">
-                    <h3 style="color: #333; margin: 0 0 10px 0;">{species_name}</h3>
-                    <p style="color: #666; font-style: italic; margin: 5px 0;">{scientific_name}</p>
-                    <p style="margin: 5px 0;"><strong>📍 Location:</strong> {location}</p>
-                    <p style="margin: 5px 0;"><strong>🕐 When:</strong> {formatted_date}</p>
-                    <p style="margin: 5px 0;"><strong>🔢 Count:</strong> {how_many} individual{'s' if how_many != 1 else ''}</p>
-                    <p style="margin: 10px 0;">
-                        <a href="{maps_url}" style="background: #4CAF50; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; display: inline-block;">
-                            📍 View on Map
-                        </a>
-                        <a href="https://ebird.org/map" style="background: #2196F3; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; display: inline-block; margin-left: 10px;">
-                            🐦 View on eBird
-                        </a>
-                    </p>
-                </div>
-            """
-        
-        html += """
-            </div>
-            
-            <div style="background: #e8f5e9; padding: 15px; border-radius: 5px; margin-top: 20px;">
-                <h3 style="color: #2e7d32;">🔍 Birding Tips:</h3>
-                <ul style="color: #333;">
-                    <li>Bring binoculars and a field guide</li>
-                    <li>Visit early morning (5-9 AM) or late afternoon (4-7 PM)</li>
-                    <li>Be quiet and patient</li>
-                    <li>Check weather conditions before going</li>
-                    <li>Respect private property and wildlife</li>
-                </ul>
-            </div>
-            
-            <p style="margin-top: 20px; color: #666; font-size: 0.9em;">
-                <em>Happy birding! 🐦 Data from eBird</em>
-            </p>
-        </body>
-        </html>
-        """
-        return html
+        return _TEMPLATE.render(sightings=sightings, radius_km=self.radius_km,
+                                max_shown=MAX_EMAIL_SIGHTINGS)
     
     def run(self):
         """Main execution"""
@@ -206,14 +327,29 @@ class BirdNotifier:
                 'sightings': []
             }
         
+        # Nothing changed since the last handled run, skip all further work
+        signature = self._sightings_signature(sightings)
+        if signature == self._get_state('last_signature'):
+            print("No changes since the last check")
+            return {
+                'alert': False,
+                'sightings_count': 0,
+                'sightings': []
+            }
+        
         # Filter new sightings (ones we haven't notified about)
         new_sightings = self.filter_new_sightings(sightings)
         
         if new_sightings:
             print(f"⚡ BIRD ALERT! Found {len(new_sightings)} new notable sightings!")
             
-            # Send notifications
-            self.send_email_notification(new_sightings)
+            # Send notifications; only remember the ones the email listed,
+            # the rest go out in a later run
+            if self.send_email_notification(new_sightings):
+                self.mark_notified(new_sightings[:MAX_EMAIL_SIGHTINGS])
+                # Only skip future runs once nothing is left waiting to be sent
+                if len(new_sightings) <= MAX_EMAIL_SIGHTINGS:
+                    self._set_state('last_signature', signature)
             
             return {
                 'alert': True,
@@ -222,6 +358,7 @@ class BirdNotifier:
             }
         else:
             print("All sightings have been notified about previously")
+            self._set_state('last_signature', signature)
             return {
                 'alert': False,
                 'sightings_count': 0,